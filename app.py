@@ -1,10 +1,13 @@
 from flask import Flask, request, jsonify, render_template
 import google.generativeai as genai
-import json
 import os
 import numpy as np
-from typing import List, Dict
-
+from functools import wraps
+from typing import List, Dict, Optional
+from semantic_cache import SemanticCache
+from index_snapshot import IndexSnapshot, SnapshotManager
+from resilience import AdmissionController, CircuitBreaker, Upstream
+from fault_injection import FaultyGenAI
 
 
 app = Flask(__name__, static_folder='static')
@@ -14,25 +17,59 @@ GOOGLE_API_KEY = os.environ.get('GOOGLE_API_KEY')
 if GOOGLE_API_KEY:
     genai.configure(api_key=GOOGLE_API_KEY)
 
-# Load processed data with embeddings
+# GENAI_STANDIN=1 swaps Gemini for a local fault-injecting stand-in
+if os.environ.get('GENAI_STANDIN'):
+    genai_client = FaultyGenAI(
+        latency=float(os.environ.get('STANDIN_LATENCY', 0)),
+        error_rate=float(os.environ.get('STANDIN_ERROR_RATE', 0))
+    )
+    print("WARNING: Using fault-injecting Gemini stand-in")
+else:
+    genai_client = genai
+
+# Upstream protection: bounded admission, per-call deadlines, circuit breaker
+EMBED_DEADLINE = float(os.environ.get('EMBED_DEADLINE', 3))
+GENERATE_DEADLINE = float(os.environ.get('GENERATE_DEADLINE', 30))
+# Keep ADMISSION_MAX_CONCURRENT + ADMISSION_MAX_QUEUE below the gunicorn
+# --threads count (8 in the Dockerfile). Extra searches then reach a thread
+# and get a fast 503, and threads stay free for /health, /api/related and
+# /api/stats.
+admission = AdmissionController(
+    max_concurrent=int(os.environ.get('ADMISSION_MAX_CONCURRENT', 3)),
+    max_queue=int(os.environ.get('ADMISSION_MAX_QUEUE', 3)),
+    queue_timeout=float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', 2))
+)
+upstream = Upstream(CircuitBreaker(
+    failure_threshold=int(os.environ.get('BREAKER_FAILURE_THRESHOLD', 5)),
+    reset_timeout=float(os.environ.get('BREAKER_RESET_TIMEOUT', 30))
+))
+
+# Semantic answer cache for near-duplicate questions
+answer_cache = SemanticCache(
+    dim=int(os.environ.get('CACHE_EMBEDDING_DIM', 768)),
+    capacity=int(os.environ.get('CACHE_CAPACITY', 1000)),
+    similarity_threshold=float(os.environ.get('CACHE_SIMILARITY_THRESHOLD', 0.92)),
+    overlap_threshold=float(os.environ.get('CACHE_OVERLAP_THRESHOLD', 0.6)),
+    policy=os.environ.get('CACHE_POLICY', 'lru')
+)
+# False-hit reports are disabled unless a token is configured
+CACHE_FEEDBACK_TOKEN = os.environ.get('CACHE_FEEDBACK_TOKEN')
+
+# Versioned index snapshots; requests pin one for their whole lifetime
 EMBEDDINGS_FILE = 'processed_data/chunks_with_embeddings.json'
-chunks_data = []
-
-def load_data():
-    global chunks_data
-    if os.path.exists(EMBEDDINGS_FILE):
-        print(f"Loading embeddings from {EMBEDDINGS_FILE}...")
-        with open(EMBEDDINGS_FILE, 'r', encoding='utf-8') as f:
-            chunks_data = json.load(f)
-        
-        # Verify embeddings exist
-        has_embeddings = sum(1 for c in chunks_data if 'embedding' in c)
-        print(f"Loaded {len(chunks_data)} chunks ({has_embeddings} with embeddings)")
-        
-        if has_embeddings == 0:
-            print("WARNING: No embeddings found! Run embedding_generator.py first!")
-    else:
-        print(f"WARNING: {EMBEDDINGS_FILE} not found! Run embedding_generator.py first!")
+KNN_GRAPH_FILE = 'processed_data/knn_graph.npz'
+INDEX_WATCH_INTERVAL = float(os.environ.get('INDEX_WATCH_INTERVAL', 0))
+# Refuse reloads that drop more than this fraction of chunks (override with ?force=1)
+INDEX_MAX_SHRINK = float(os.environ.get('INDEX_MAX_SHRINK', 0.5))
+RELOAD_TOKEN = os.environ.get('RELOAD_TOKEN')
+
+def on_index_swap(snapshot: IndexSnapshot):
+    # Entries are version-tagged, so this only frees answers from the
+    # previous corpus that can no longer match
+    answer_cache.clear()
+
+snapshots = SnapshotManager(EMBEDDINGS_FILE, KNN_GRAPH_FILE, on_swap=on_index_swap,
+                            max_shrink=INDEX_MAX_SHRINK)
 
 def cosine_similarity(vec1, vec2):
     """Calculate cosine similarity between two vectors"""
@@ -48,31 +85,45 @@ def cosine_similarity(vec1, vec2):
     
     return dot_product / (norm1 * norm2)
 
-def semantic_search(query: str, top_k: int = 5) -> List[Dict]:
+def embed_query(query: str) -> Optional[List[float]]:
+    """Embed a search query, returning None if the call fails"""
+    try:
+        query_result = upstream.call(
+            genai_client.embed_content, EMBED_DEADLINE,
+            model="models/text-embedding-004",
+            content=query,
+            task_type="retrieval_query",
+            request_options={'timeout': EMBED_DEADLINE}
+        )
+        return query_result['embedding']
+    except Exception as e:
+        print(f"Query embedding error: {str(e)}")
+        return None
+
+def semantic_search(query: str, top_k: int = 5,
+                    query_embedding: Optional[List[float]] = None,
+                    snapshot: Optional[IndexSnapshot] = None) -> List[Dict]:
     """Semantic search using pre-computed embeddings"""
     
-    if not chunks_data:
+    snapshot = snapshot or snapshots.current()
+    if not snapshot.chunks:
         return []
     
     # Check if we have embeddings
-    has_embeddings = any('embedding' in chunk for chunk in chunks_data)
-    
-    if not has_embeddings:
+    if not snapshot.has_embeddings:
         print("WARNING: No embeddings found, falling back to keyword search")
-        return keyword_search(query, top_k)
+        return keyword_search(query, top_k, snapshot=snapshot)
+    
+    if query_embedding is None:
+        query_embedding = embed_query(query)
+    if query_embedding is None:
+        # Fallback to keyword search
+        return keyword_search(query, top_k, snapshot=snapshot)
     
     try:
-        # Get query embedding
-        query_result = genai.embed_content(
-            model="models/text-embedding-004",
-            content=query,
-            task_type="retrieval_query"
-        )
-        query_embedding = query_result['embedding']
-        
         # Calculate similarities
         results = []
-        for chunk in chunks_data:
+        for chunk in snapshot.chunks:
             if 'embedding' not in chunk:
                 continue
             
@@ -92,15 +143,17 @@ def semantic_search(query: str, top_k: int = 5) -> List[Dict]:
     except Exception as e:
         print(f"Semantic search error: {str(e)}")
         # Fallback to keyword search
-        return keyword_search(query, top_k)
+        return keyword_search(query, top_k, snapshot=snapshot)
 
-def keyword_search(query: str, top_k: int = 5) -> List[Dict]:
+def keyword_search(query: str, top_k: int = 5,
+                   snapshot: Optional[IndexSnapshot] = None) -> List[Dict]:
     """Fallback keyword-based search"""
+    snapshot = snapshot or snapshots.current()
     results = []
     query_lower = query.lower()
     query_words = set(query_lower.split())
     
-    for chunk in chunks_data:
+    for chunk in snapshot.chunks:
         chunk_lower = chunk['text'].lower()
         chunk_words = set(chunk_lower.split())
         matches = len(query_words.intersection(chunk_words))
@@ -114,15 +167,27 @@ def keyword_search(query: str, top_k: int = 5) -> List[Dict]:
     results.sort(key=lambda x: x['score'], reverse=True)
     return [r['chunk'] for r in results[:top_k]]
 
+def also_in(chunk: Dict) -> str:
+    """Attribution suffix for texts collapsed into this chunk at ingest"""
+    duplicates = chunk.get('duplicates', [])
+    if not duplicates:
+        return ""
+    others = "; ".join(f"'{d['title']}' by {d['author']} ({d['year']})" for d in duplicates)
+    return f" [also appears in {others}]"
+
 def generate_response(query: str, context_chunks: List[Dict]) -> str:
-    """Generate response using Gemini with retrieved context"""
+    """Generate response using Gemini with retrieved context.
+    
+    Upstream failures are raised so the caller can fall back to a
+    retrieval-only answer.
+    """
     
     if not context_chunks:
         return "I couldn't find relevant passages in the slave narratives to answer your question."
     
     # Build context from chunks
     context = "\n\n---\n\n".join([
-        f"From '{chunk['title']}' by {chunk['author']} ({chunk['year']}):\n{chunk['text']}"
+        f"From '{chunk['title']}' by {chunk['author']} ({chunk['year']}){also_in(chunk)}:\n{chunk['text']}"
         for chunk in context_chunks
     ])
     
@@ -145,18 +210,39 @@ USER QUESTION: {query}
 
 Please provide a thoughtful, well-cited response:"""
 
-    try:
-        model = genai.GenerativeModel('gemini-2.5-flash')
-        response = model.generate_content(prompt)
-        return response.text
-    except Exception as e:
-        return f"Error generating response: {str(e)}"
+    model = genai_client.GenerativeModel('gemini-2.5-flash')
+    response = upstream.call(model.generate_content, GENERATE_DEADLINE, prompt,
+                             request_options={'timeout': GENERATE_DEADLINE})
+    return response.text
+
+def retrieval_only_response(context_chunks: List[Dict]) -> str:
+    """Answer built from the retrieved passages alone, used when Gemini is down"""
+    passages = "\n\n".join(
+        f"From '{chunk['title']}' by {chunk['author']} ({chunk['year']}):\n{chunk['text'][:500]}..."
+        for chunk in context_chunks
+    )
+    return f"The AI assistant is temporarily unavailable. Here are the most relevant passages found for your question:\n\n{passages}"
+
+def admission_controlled(view):
+    """Reject with 503 when too many upstream-bound requests are in flight"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not admission.try_acquire():
+            response = jsonify({'error': 'Server busy, please retry shortly'})
+            response.headers['Retry-After'] = '1'
+            return response, 503
+        try:
+            return view(*args, **kwargs)
+        finally:
+            admission.release()
+    return wrapper
 
 @app.route('/')
 def index():
     return render_template('index.html') 
 
 @app.route('/api/search', methods=['POST'])
+@admission_controlled
 def search():
     """Search endpoint"""
     data = request.json
@@ -165,48 +251,121 @@ def search():
     if not query:
         return jsonify({'error': 'No query provided'}), 400
     
-    # Get relevant chunks using semantic search
-    relevant_chunks = semantic_search(query, top_k=5)
-    
-    # Generate response
-    answer = generate_response(query, relevant_chunks)
-    
-    # Format sources
-    sources = []
-    seen = set()
-    for chunk in relevant_chunks:
-        key = f"{chunk['author']}|{chunk['title']}"
-        if key not in seen:
-            sources.append({
+    # Pin one index snapshot for the whole request so a reload can't
+    # swap the corpus out from under it
+    query_embedding = embed_query(query)
+    with snapshots.acquire() as snapshot:
+        # Get relevant chunks using semantic search, or keyword search
+        # straight away when the embedder is unavailable
+        if query_embedding is not None:
+            relevant_chunks = semantic_search(query, top_k=5, query_embedding=query_embedding,
+                                              snapshot=snapshot)
+        else:
+            relevant_chunks = keyword_search(query, top_k=5, snapshot=snapshot)
+        chunk_ids = [chunk['id'] for chunk in relevant_chunks]
+        
+        # Reuse an answer from a near-duplicate question if we have one
+        answer = None
+        cached = None
+        if query_embedding is not None and relevant_chunks:
+            cached = answer_cache.lookup(query_embedding, chunk_ids, version=snapshot.version)
+            if cached is not None:
+                answer = cached['answer']
+        
+        # Generate response, or answer from the passages alone if Gemini fails
+        degraded = False
+        if answer is None:
+            try:
+                answer = generate_response(query, relevant_chunks)
+            except Exception as e:
+                print(f"Generation error: {str(e)}")
+                answer = retrieval_only_response(relevant_chunks)
+                degraded = True
+            # Tagged with this request's snapshot version, so an answer that
+            # lands after a reload is never served for the new corpus
+            if query_embedding is not None and relevant_chunks and not degraded:
+                answer_cache.store(query, query_embedding, chunk_ids, answer,
+                                   version=snapshot.version)
+        
+        # Format sources
+        sources = []
+        seen = set()
+        for chunk in relevant_chunks:
+            for source in [chunk] + chunk.get('duplicates', []):
+                key = f"{source['author']}|{source['title']}"
+                if key not in seen:
+                    sources.append({
+                        'author': source['author'],
+                        'title': source['title'],
+                        'year': source['year']
+                    })
+                    seen.add(key)
+        
+        return jsonify({
+            'answer': answer,
+            'cached': cached is not None,
+            'cache_serve_token': cached['serve_token'] if cached else None,
+            'degraded': degraded,
+            'sources': sources,
+            'relevant_passages': [
+                {
+                    'id': chunk['id'],
+                    'text': chunk['text'][:300] + '...',
+                    'author': chunk['author'],
+                    'title': chunk['title'],
+                    'year': chunk['year']
+                }
+                for chunk in relevant_chunks[:3]
+            ]
+        })
+
+@app.route('/api/related/<chunk_id>', methods=['GET'])
+def related(chunk_id):
+    """Passages from other narratives most similar to the given chunk"""
+    with snapshots.acquire() as snapshot:
+        knn_graph = snapshot.knn_graph
+        if knn_graph is None:
+            return jsonify({'error': 'Related passages graph not built'}), 503
+        
+        row = snapshot.knn_rows.get(chunk_id)
+        if row is None or chunk_id not in snapshot.chunks_by_id:
+            return jsonify({'error': 'Unknown chunk id'}), 404
+        
+        limit = request.args.get('k', default=5, type=int)
+        lo, hi = knn_graph['indptr'][row], knn_graph['indptr'][row + 1]
+        hi = min(hi, lo + max(limit, 0))
+        
+        passages = []
+        for neighbor, score in zip(knn_graph['indices'][lo:hi], knn_graph['scores'][lo:hi]):
+            chunk = snapshot.chunks_by_id.get(str(knn_graph['ids'][neighbor]))
+            if chunk is None:
+                continue
+            passages.append({
+                'id': chunk['id'],
+                'text': chunk['text'][:300] + '...',
                 'author': chunk['author'],
                 'title': chunk['title'],
-                'year': chunk['year']
+                'year': chunk['year'],
+                'score': float(score)
             })
-            seen.add(key)
     
     return jsonify({
-        'answer': answer,
-        'sources': sources,
-        'relevant_passages': [
-            {
-                'text': chunk['text'][:300] + '...',
-                'author': chunk['author'],
-                'title': chunk['title'],
-                'year': chunk['year']
-            }
-            for chunk in relevant_chunks[:3]
-        ]
+        'chunk_id': chunk_id,
+        'related_passages': passages
     })
 
 @app.route('/api/stats', methods=['GET'])
 def stats():
     """Get corpus statistics"""
+    chunks_data = snapshots.current().chunks
     if not chunks_data:
         return jsonify({'error': 'No data loaded'}), 500
     
-    authors = set(chunk['author'] for chunk in chunks_data)
-    years = set(chunk['year'] for chunk in chunks_data)
-    narratives = set(chunk['filename'] for chunk in chunks_data)
+    # Include texts whose chunks were collapsed into canonical ones at ingest
+    sources = [source for chunk in chunks_data for source in [chunk] + chunk.get('duplicates', [])]
+    authors = set(source['author'] for source in sources)
+    years = set(source['year'] for source in sources)
+    narratives = set(source['filename'] for source in sources)
     has_embeddings = sum(1 for chunk in chunks_data if 'embedding' in chunk)
     
     return jsonify({
@@ -218,16 +377,62 @@ def stats():
         'embeddings_ready': has_embeddings > 0
     })
 
+@app.route('/api/cache/stats', methods=['GET'])
+def cache_stats():
+    """Semantic cache hit-rate and false-hit metrics for threshold tuning"""
+    return jsonify(answer_cache.stats())
+
+@app.route('/api/cache/false_hit', methods=['POST'])
+def cache_false_hit():
+    """Report that a cached answer did not fit the question it was served for"""
+    if not CACHE_FEEDBACK_TOKEN:
+        return jsonify({'error': 'Not found'}), 404
+    if request.headers.get('X-Feedback-Token') != CACHE_FEEDBACK_TOKEN:
+        return jsonify({'error': 'Invalid feedback token'}), 403
+    
+    data = request.json or {}
+    serve_token = data.get('cache_serve_token')
+    
+    if not isinstance(serve_token, str):
+        return jsonify({'error': 'No cache_serve_token provided'}), 400
+    
+    if not answer_cache.report_false_hit(serve_token):
+        return jsonify({'error': 'Unknown, expired or already reported serve token'}), 404
+    
+    return jsonify({'reported': True})
+
+@app.route('/api/admin/reload', methods=['POST'])
+def reload_index():
+    """Load the current index files in the background and swap them in"""
+    # Disabled unless a token is configured: each reload parses the whole index
+    if not RELOAD_TOKEN:
+        return jsonify({'error': 'Not found'}), 404
+    if request.headers.get('X-Reload-Token') != RELOAD_TOKEN:
+        return jsonify({'error': 'Invalid reload token'}), 403
+    
+    force = request.args.get('force') == '1'
+    started = snapshots.reload_async(force=force)
+    return jsonify({
+        'reload_started': started,
+        'active_version': snapshots.current().version
+    }), 202 if started else 409
+
 @app.route('/health', methods=['GET'])
 def health():
     """Health check endpoint"""
+    snapshot = snapshots.current()
     return jsonify({
         'status': 'healthy',
-        'chunks_loaded': len(chunks_data),
-        'embeddings_available': any('embedding' in c for c in chunks_data)
+        'chunks_loaded': len(snapshot.chunks),
+        'embeddings_available': snapshot.has_embeddings,
+        'index': snapshots.stats(),
+        'upstream': dict(upstream.breaker.stats(), saturated=upstream.saturated),
+        'admission': admission.stats()
     })
 
-load_data()
+snapshots.reload()
+if INDEX_WATCH_INTERVAL > 0:
+    snapshots.watch(INDEX_WATCH_INTERVAL)
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 8080))
@@ -13,6 +13,9 @@ genai.configure(api_key=GOOGLE_API_KEY)
 
 INPUT_FILE = 'processed_data/processed_chunks.json'
 OUTPUT_FILE = 'processed_data/chunks_with_embeddings.json'
+# Intermediate results go here; OUTPUT_FILE only appears once complete, so
+# the app's index watcher never loads a partial corpus
+PARTIAL_FILE = OUTPUT_FILE + '.partial'
 
 def generate_embeddings_batch(chunks, batch_size=100):
     """Generate embeddings for chunks in batches"""
@@ -60,10 +63,16 @@ def generate_embeddings_batch(chunks, batch_size=100):
         
         # Save intermediate results after each batch
         print(f"  Saving intermediate results...")
-        with open(OUTPUT_FILE, 'w', encoding='utf-8') as f:
+        with open(PARTIAL_FILE, 'w', encoding='utf-8') as f:
             json.dump(chunks_with_embeddings, f)
         
-        print(f"  Batch {batch_num} complete. Saved to {OUTPUT_FILE}\n")
+        print(f"  Batch {batch_num} complete. Saved to {PARTIAL_FILE}\n")
+    
+    # Publish the finished file in one step
+    if not chunks:
+        with open(PARTIAL_FILE, 'w', encoding='utf-8') as f:
+            json.dump(chunks_with_embeddings, f)
+    os.replace(PARTIAL_FILE, OUTPUT_FILE)
     
     print(f"\nEmbedding generation complete!")
     print(f"Successfully processed: {len(chunks_with_embeddings) - failed}")
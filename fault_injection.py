@@ -0,0 +1,73 @@
+import random
+import re
+import threading
+import time
+import zlib
+
+import numpy as np
+
+
+class FaultInjectionError(Exception):
+    """Error raised by the stand-in to simulate an upstream failure"""
+
+
+class FaultyGenAI:
+    """Local stand-in for the parts of google.generativeai the app uses.
+
+    Every call sleeps for ``latency`` seconds and then fails with probability
+    ``error_rate``. Both can be changed at runtime (e.g. from a shell or a
+    test) to simulate slowdowns and outages without touching Gemini.
+    Embeddings are hashed bags of words, so similar texts get similar vectors.
+    """
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0,
+                 dim: int = 768, seed: int = 0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.dim = dim
+        self.calls = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _inject(self, request_options=None):
+        with self._lock:
+            self.calls += 1
+            fail = self._random.random() < self.error_rate
+
+        # Honour the client-side timeout the way the real library does
+        timeout = (request_options or {}).get('timeout')
+        if timeout is not None and self.latency > timeout:
+            time.sleep(timeout)
+            raise FaultInjectionError(f"Injected timeout after {timeout}s")
+        if self.latency:
+            time.sleep(self.latency)
+        if fail:
+            raise FaultInjectionError("Injected upstream failure")
+
+    def _embed(self, text: str):
+        vec = np.zeros(self.dim, dtype=np.float32)
+        for word in re.findall(r"\w+", text.lower()):
+            vec[zlib.crc32(word.encode('utf-8')) % self.dim] += 1.0
+        return vec.tolist()
+
+    def embed_content(self, model: str, content: str, task_type: str = None,
+                      request_options=None, **kwargs):
+        self._inject(request_options)
+        return {'embedding': self._embed(content)}
+
+    def GenerativeModel(self, model_name: str):
+        return _FaultyModel(self)
+
+
+class _FaultyResponse:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class _FaultyModel:
+    def __init__(self, client: FaultyGenAI):
+        self._client = client
+
+    def generate_content(self, prompt: str, request_options=None, **kwargs):
+        self._client._inject(request_options)
+        return _FaultyResponse(f"[stand-in answer for a {len(prompt)}-character prompt]")
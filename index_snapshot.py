@@ -0,0 +1,212 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+from knn_graph import content_hashes, load_graph, prepare_embeddings
+
+
+class IndexSnapshot:
+    """Immutable view of the corpus: chunks plus the related-passages graph"""
+
+    def __init__(self, version: int, chunks: List[Dict], knn_graph: Optional[Dict],
+                 source_mtimes: Dict[str, Optional[float]]):
+        self.version = version
+        self.chunks = chunks
+        self.chunks_by_id = {chunk['id']: chunk for chunk in chunks}
+        self.has_embeddings = any('embedding' in chunk for chunk in chunks)
+        self.knn_graph = knn_graph
+        self.knn_rows = {}
+        if knn_graph is not None:
+            self.knn_rows = {str(chunk_id): row for row, chunk_id in enumerate(knn_graph['ids'])}
+        self.source_mtimes = source_mtimes
+        self.loaded_at = time.time()
+        self.refs = 0
+
+
+def graph_matches_chunks(knn_graph: Dict, chunks: List[Dict]) -> bool:
+    """True if every graph row was built from the embedding its chunk has now"""
+    if knn_graph.get('hashes') is None:
+        return False
+
+    ids, _, matrix = prepare_embeddings(chunks)
+    current = dict(zip(ids, content_hashes(matrix)))
+    for chunk_id, stored in zip(knn_graph['ids'], knn_graph['hashes']):
+        if current.get(str(chunk_id)) != stored:
+            return False
+    return True
+
+
+def _mtime(path: str) -> Optional[float]:
+    return os.path.getmtime(path) if os.path.exists(path) else None
+
+
+class SnapshotManager:
+    """Loads index snapshots and swaps them in atomically.
+
+    Requests take the active snapshot with ``acquire()`` and use it for their
+    whole lifetime, so a reload never changes data under an in-flight
+    request. Replaced snapshots are kept as retired until their last request
+    finishes, then dropped.
+
+    A reload that would shrink the corpus by more than ``max_shrink`` (a
+    fraction of the active chunk count) is refused unless forced.
+    """
+
+    def __init__(self, embeddings_file: str, graph_file: str, on_swap=None,
+                 max_shrink: float = 0.5):
+        self.embeddings_file = embeddings_file
+        self.graph_file = graph_file
+        self.on_swap = on_swap
+        self.max_shrink = max_shrink
+
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self._active = IndexSnapshot(0, [], None, {})
+        self._retired = []
+        self._next_version = 1
+        self.last_error = None
+
+    def current(self) -> IndexSnapshot:
+        return self._active
+
+    @contextmanager
+    def acquire(self):
+        with self._lock:
+            snapshot = self._active
+            snapshot.refs += 1
+        try:
+            yield snapshot
+        finally:
+            with self._lock:
+                snapshot.refs -= 1
+                self._release_drained()
+
+    def _release_drained(self):
+        # Caller holds self._lock
+        for snapshot in [s for s in self._retired if s.refs == 0]:
+            self._retired.remove(snapshot)
+            print(f"Released index snapshot v{snapshot.version}")
+
+    def _build(self, force: bool = False) -> IndexSnapshot:
+        source_mtimes = {
+            self.embeddings_file: _mtime(self.embeddings_file),
+            self.graph_file: _mtime(self.graph_file)
+        }
+
+        chunks = []
+        if os.path.exists(self.embeddings_file):
+            print(f"Loading embeddings from {self.embeddings_file}...")
+            with open(self.embeddings_file, 'r', encoding='utf-8') as f:
+                chunks = json.load(f)
+
+            # Verify embeddings exist
+            has_embeddings = sum(1 for c in chunks if 'embedding' in c)
+            print(f"Loaded {len(chunks)} chunks ({has_embeddings} with embeddings)")
+
+            if has_embeddings == 0:
+                print("WARNING: No embeddings found! Run embedding_generator.py first!")
+
+            active_count = len(self._active.chunks)
+            if not force and len(chunks) < active_count * (1 - self.max_shrink):
+                raise ValueError(f"New index has {len(chunks)} chunks, down from {active_count}; "
+                                 f"force the reload to accept it")
+        elif self._active.version:
+            # Never replace a working index with an empty one
+            raise FileNotFoundError(f"{self.embeddings_file} not found")
+        else:
+            print(f"WARNING: {self.embeddings_file} not found! Run embedding_generator.py first!")
+
+        knn_graph = load_graph(self.graph_file)
+        if knn_graph is not None and not graph_matches_chunks(knn_graph, chunks):
+            # Ids are positional, so a stale graph would serve neighbours of other text
+            print(f"WARNING: {self.graph_file} does not match the loaded chunks! "
+                  f"Re-run knn_graph.py; related passages disabled")
+            knn_graph = None
+        elif knn_graph is not None:
+            print(f"Loaded related-passages graph ({len(knn_graph['ids'])} chunks)")
+        else:
+            print(f"WARNING: {self.graph_file} not found! Run knn_graph.py to enable related passages")
+
+        with self._lock:
+            version = self._next_version
+            self._next_version += 1
+        return IndexSnapshot(version, chunks, knn_graph, source_mtimes)
+
+    def reload(self, force: bool = False) -> bool:
+        """Build a new snapshot and swap it in; keeps the old one on failure.
+
+        Does nothing if the source files are unchanged since the active
+        snapshot was built. ``force`` skips the shrink check.
+        """
+        with self._reload_lock:
+            active = self._active
+            mtimes = {path: _mtime(path) for path in (self.embeddings_file, self.graph_file)}
+            if active.version and mtimes == active.source_mtimes:
+                print(f"Index files unchanged, keeping v{active.version}")
+                return True
+
+            try:
+                snapshot = self._build(force)
+            except Exception as e:
+                self.last_error = str(e)
+                print(f"Index reload failed, keeping v{self._active.version}: {str(e)}")
+                return False
+
+            with self._lock:
+                old = self._active
+                self._active = snapshot
+                if old.version:
+                    self._retired.append(old)
+                self._release_drained()
+            self.last_error = None
+            print(f"Activated index snapshot v{snapshot.version}")
+
+        if self.on_swap:
+            self.on_swap(snapshot)
+        return True
+
+    def reload_async(self, force: bool = False) -> bool:
+        """Start a background reload; False if one is already running"""
+        if self._reload_lock.locked():
+            return False
+        threading.Thread(target=self.reload, args=(force,), name='index-reload', daemon=True).start()
+        return True
+
+    def watch(self, interval: float):
+        """Reload in the background whenever the source files change.
+
+        embedding_generator.py and knn_graph.py write to a temporary file and
+        rename it into place when finished, so a changed mtime means a
+        complete file. Waiting for the mtimes to hold for one interval also
+        lets a graph rebuild that follows new embeddings land in the same
+        reload.
+        """
+        def loop():
+            pending = None
+            while True:
+                time.sleep(interval)
+                mtimes = {path: _mtime(path) for path in (self.embeddings_file, self.graph_file)}
+                if mtimes == self._active.source_mtimes:
+                    pending = None
+                elif mtimes == pending:
+                    self.reload()
+                    pending = None
+                else:
+                    pending = mtimes
+
+        threading.Thread(target=loop, name='index-watch', daemon=True).start()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            active = self._active
+            return {
+                'version': active.version,
+                'loaded_at': active.loaded_at,
+                'chunks': len(active.chunks),
+                'in_flight': active.refs,
+                'draining': [{'version': s.version, 'in_flight': s.refs} for s in self._retired],
+                'last_error': self.last_error
+            }
@@ -0,0 +1,249 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+from multiprocessing import Pool
+
+import numpy as np
+
+INPUT_FILE = 'processed_data/chunks_with_embeddings.json'
+OUTPUT_FILE = 'processed_data/knn_graph.npz'
+NEIGHBORS = 10
+BLOCK_SIZE = 1024
+
+# Set in each worker by _init_worker so blocks don't re-send the matrix
+_matrix = None
+_groups = None
+
+
+def prepare_embeddings(chunks):
+    """Return ids, narrative group per row and the normalized embedding matrix"""
+    chunks = [c for c in chunks if 'embedding' in c]
+    ids = [c['id'] for c in chunks]
+
+    filenames = {}
+    groups = np.array([filenames.setdefault(c['filename'], len(filenames)) for c in chunks],
+                      dtype=np.int32)
+
+    matrix = np.array([c['embedding'] for c in chunks], dtype=np.float32)
+    if len(matrix):
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        matrix /= norms
+
+    return ids, groups, matrix
+
+
+def content_hashes(matrix):
+    """64-bit hash of each embedding row, to spot chunks whose content changed"""
+    return np.array([int.from_bytes(hashlib.blake2b(row.tobytes(), digest_size=8).digest(), 'little')
+                     for row in matrix], dtype=np.uint64)
+
+
+def _init_worker(matrix, groups):
+    global _matrix, _groups
+    _matrix = matrix
+    _groups = groups
+
+
+def _top_k(scores, k):
+    """Indices and scores of the k best columns per row, best first"""
+    k = min(k, scores.shape[1])
+    if k == 0:
+        return np.empty((scores.shape[0], 0), dtype=np.int64), np.empty((scores.shape[0], 0), dtype=np.float32)
+
+    idx = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    top = np.take_along_axis(scores, idx, axis=1)
+    order = np.argsort(-top, axis=1)
+    return np.take_along_axis(idx, order, axis=1), np.take_along_axis(top, order, axis=1)
+
+
+def _knn_block(task):
+    """Neighbours for rows [start, end) against columns `cols` (all if None)"""
+    start, end, cols, k = task
+    rows = _matrix[start:end]
+
+    if cols is None:
+        col_idx = np.arange(len(_matrix))
+    else:
+        col_idx = np.asarray(cols)
+    scores = rows @ _matrix[col_idx].T
+
+    # Only neighbours from other narratives (this also drops self-matches)
+    same = _groups[start:end, None] == _groups[col_idx][None, :]
+    scores[same] = -np.inf
+
+    idx, top = _top_k(scores, k)
+    return start, col_idx[idx], top
+
+
+def _run_blocks(matrix, groups, row_ranges, cols, k, workers):
+    tasks = [(start, end, cols, k) for start, end in row_ranges]
+    if workers > 1 and len(tasks) > 1:
+        with Pool(workers, initializer=_init_worker, initargs=(matrix, groups)) as pool:
+            return pool.map(_knn_block, tasks)
+
+    _init_worker(matrix, groups)
+    return [_knn_block(task) for task in tasks]
+
+
+def _to_csr(ids, hashes, neighbors, scores):
+    """Pack per-row neighbour lists into CSR arrays, dropping masked entries"""
+    indptr = np.zeros(len(ids) + 1, dtype=np.int64)
+    all_indices = []
+    all_scores = []
+
+    for row, (idx, top) in enumerate(zip(neighbors, scores)):
+        keep = np.isfinite(top)
+        all_indices.append(idx[keep].astype(np.int32))
+        all_scores.append(top[keep].astype(np.float32))
+        indptr[row + 1] = indptr[row] + keep.sum()
+
+    return {
+        'ids': np.array(ids),
+        'hashes': hashes,
+        'indptr': indptr,
+        'indices': np.concatenate(all_indices) if all_indices else np.empty(0, dtype=np.int32),
+        'scores': np.concatenate(all_scores) if all_scores else np.empty(0, dtype=np.float32)
+    }
+
+
+def build_graph(ids, groups, matrix, k=NEIGHBORS, block_size=BLOCK_SIZE, workers=None):
+    """Build the full cross-narrative kNN graph, one row block per task"""
+    workers = workers or os.cpu_count() or 1
+    n = len(ids)
+    row_ranges = [(start, min(start + block_size, n)) for start in range(0, n, block_size)]
+
+    neighbors = [None] * n
+    scores = [None] * n
+    for start, idx, top in _run_blocks(matrix, groups, row_ranges, None, k, workers):
+        for offset in range(len(idx)):
+            neighbors[start + offset] = idx[offset]
+            scores[start + offset] = top[offset]
+
+    return _to_csr(ids, content_hashes(matrix), neighbors, scores)
+
+
+def update_graph(graph, ids, groups, matrix, k=NEIGHBORS, block_size=BLOCK_SIZE, workers=None):
+    """Extend an existing graph with newly added chunks.
+
+    New chunks get a full neighbour search. Existing chunks are only scored
+    against the new ones and keep whichever of old/new neighbours are best.
+    Returns None when chunks were removed or changed (ids are positional, so
+    re-chunking keeps them while the content moves), since that needs a full
+    rebuild. Graphs saved without content hashes are always rebuilt.
+    """
+    workers = workers or os.cpu_count() or 1
+    position = {chunk_id: i for i, chunk_id in enumerate(ids)}
+    old_ids = [str(chunk_id) for chunk_id in graph['ids']]
+    if any(chunk_id not in position for chunk_id in old_ids):
+        return None
+
+    if graph.get('hashes') is None:
+        return None
+    hashes = content_hashes(matrix)
+    # Old graph indices -> positions in the new id list
+    old_positions = np.array([position[chunk_id] for chunk_id in old_ids], dtype=np.int64)
+    if not np.array_equal(hashes[old_positions], graph['hashes']):
+        return None
+
+    old_set = set(old_ids)
+    new_rows = [i for i, chunk_id in enumerate(ids) if chunk_id not in old_set]
+    if not new_rows:
+        return graph
+
+    neighbors = [None] * len(ids)
+    scores = [None] * len(ids)
+    for row, chunk_id in enumerate(old_ids):
+        lo, hi = graph['indptr'][row], graph['indptr'][row + 1]
+        neighbors[position[chunk_id]] = old_positions[graph['indices'][lo:hi]]
+        scores[position[chunk_id]] = graph['scores'][lo:hi]
+
+    # Rows are processed contiguously, so group new rows into runs
+    def runs(rows):
+        ranges = []
+        for row in rows:
+            if ranges and ranges[-1][1] == row and row - ranges[-1][0] < block_size:
+                ranges[-1][1] = row + 1
+            else:
+                ranges.append([row, row + 1])
+        return [tuple(r) for r in ranges]
+
+    for start, idx, top in _run_blocks(matrix, groups, runs(new_rows), None, k, workers):
+        for offset in range(len(idx)):
+            neighbors[start + offset] = idx[offset]
+            scores[start + offset] = top[offset]
+
+    old_rows = sorted(position[chunk_id] for chunk_id in old_ids)
+    for start, idx, top in _run_blocks(matrix, groups, runs(old_rows), new_rows, k, workers):
+        for offset in range(len(idx)):
+            row = start + offset
+            merged_idx = np.concatenate([neighbors[row], idx[offset]])
+            merged_scores = np.concatenate([scores[row], top[offset]])
+            best, best_scores = _top_k(merged_scores[None, :], k)
+            neighbors[row] = merged_idx[best[0]]
+            scores[row] = best_scores[0]
+
+    return _to_csr(ids, hashes, neighbors, scores)
+
+
+def save_graph(graph, path=OUTPUT_FILE):
+    # Write then rename so readers never see a half-written graph
+    partial = path + '.partial'
+    with open(partial, 'wb') as f:
+        np.savez_compressed(f, **graph)
+    os.replace(partial, path)
+
+
+def load_graph(path=OUTPUT_FILE):
+    """Load CSR arrays saved by save_graph, or None if there is no graph yet"""
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        graph = {key: data[key] for key in ('ids', 'indptr', 'indices', 'scores')}
+        graph['hashes'] = data['hashes'] if 'hashes' in data else None
+        return graph
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the related-passages kNN graph")
+    parser.add_argument('--full', action='store_true', help="rebuild from scratch")
+    parser.add_argument('-k', type=int, default=NEIGHBORS)
+    parser.add_argument('--block-size', type=int, default=BLOCK_SIZE)
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    if not os.path.exists(INPUT_FILE):
+        print(f"ERROR: {INPUT_FILE} not found!")
+        print("Run embedding_generator.py first!")
+        return
+
+    print(f"Loading chunks from {INPUT_FILE}...")
+    with open(INPUT_FILE, 'r', encoding='utf-8') as f:
+        chunks = json.load(f)
+
+    ids, groups, matrix = prepare_embeddings(chunks)
+    print(f"Loaded {len(ids)} chunks with embeddings")
+
+    start_time = time.time()
+    graph = None
+    existing = None if args.full else load_graph()
+    if existing is not None:
+        print(f"Updating existing graph ({len(existing['ids'])} chunks)...")
+        graph = update_graph(existing, ids, groups, matrix, args.k, args.block_size, args.workers)
+        if graph is None:
+            print("Chunks were removed or changed since the last build, rebuilding from scratch...")
+
+    if graph is None:
+        print(f"Building {args.k}-NN graph...")
+        graph = build_graph(ids, groups, matrix, args.k, args.block_size, args.workers)
+
+    save_graph(graph)
+    print(f"Graph built in {time.time() - start_time:.1f}s")
+    print(f"Edges: {len(graph['indices'])}")
+    print(f"Saved to: {OUTPUT_FILE}")
+
+
+if __name__ == "__main__":
+    main()
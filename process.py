@@ -1,13 +1,27 @@
 import os
 import re
 import json
+import zlib
 from pathlib import Path
 
+import numpy as np
+
 INPUT_DIR = "slave_narratives"
 OUTPUT_DIR = "processed_data"
 CHUNK_SIZE = 1000
 CHUNK_OVERLAP = 200
 
+# Near-duplicate detection (MinHash + LSH)
+SHINGLE_SIZE = 5
+NUM_PERMUTATIONS = 128
+LSH_BANDS = 16  # 16 bands x 8 rows: candidates from ~0.7 Jaccard
+DUPLICATE_THRESHOLD = 0.8
+MINHASH_PRIME = (1 << 31) - 1
+
+def canonical_order(year, filename):
+    """Sort key for choosing the canonical copy among near-duplicates"""
+    return (year, filename)
+
 def clean_gutenberg_text(text):
     """Remove Project Gutenberg headers and footers"""
     
@@ -74,6 +88,106 @@ def chunk_text(text, chunk_size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
     
     return chunks
 
+def shingle_hashes(text, size=SHINGLE_SIZE):
+    """Hash every word n-gram of the text to a 32-bit integer"""
+    words = re.findall(r"\w+", text.lower())
+    shingles = {' '.join(words[i:i + size]) for i in range(max(len(words) - size + 1, 1))}
+    return np.array([zlib.crc32(s.encode('utf-8')) for s in shingles], dtype=np.uint64)
+
+def minhash_signature(hashes, num_perm=NUM_PERMUTATIONS, seed=42, batch=10000):
+    """MinHash signature using universal hashes (a*x + b) mod p"""
+    rng = np.random.RandomState(seed)
+    a = rng.randint(1, MINHASH_PRIME, size=num_perm).astype(np.uint64)
+    b = rng.randint(0, MINHASH_PRIME, size=num_perm).astype(np.uint64)
+    
+    signature = np.full(num_perm, MINHASH_PRIME, dtype=np.uint64)
+    hashes = hashes % MINHASH_PRIME
+    
+    # Work through long texts in slices to keep the hash matrix small
+    for i in range(0, len(hashes), batch):
+        block = hashes[i:i + batch]
+        permuted = (np.outer(a, block) + b[:, None]) % MINHASH_PRIME
+        signature = np.minimum(signature, permuted.min(axis=1))
+    
+    return signature
+
+def find_near_duplicates(signatures, bands=LSH_BANDS, threshold=DUPLICATE_THRESHOLD):
+    """Group near-duplicate items using LSH banding over MinHash signatures.
+    
+    Returns a list of clusters (lists of indices) with more than one member.
+    Candidate pairs from shared buckets are verified against the estimated
+    Jaccard similarity before being merged.
+    """
+    if len(signatures) == 0:
+        return []
+    
+    signatures = np.asarray(signatures)
+    rows = signatures.shape[1] // bands
+    
+    parent = list(range(len(signatures)))
+    
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+    
+    for band in range(bands):
+        buckets = {}
+        band_slice = signatures[:, band * rows:(band + 1) * rows]
+        for idx, key in enumerate(band_slice):
+            buckets.setdefault(key.tobytes(), []).append(idx)
+        
+        for members in buckets.values():
+            first = members[0]
+            for other in members[1:]:
+                root_first, root_other = find(first), find(other)
+                if root_first == root_other:
+                    continue
+                similarity = np.mean(signatures[first] == signatures[other])
+                if similarity >= threshold:
+                    parent[root_other] = root_first
+    
+    clusters = {}
+    for idx in range(len(signatures)):
+        clusters.setdefault(find(idx), []).append(idx)
+    
+    return [members for members in clusters.values() if len(members) > 1]
+
+def collapse_duplicate_chunks(chunks):
+    """Keep one canonical chunk per near-duplicate cluster.
+    
+    The earliest chunk (by year, filename, position) is kept and gets a
+    'duplicates' list pointing back at the chunks folded into it. Returns
+    the remaining chunks and a duplicate id -> canonical id mapping.
+    """
+    signatures = [minhash_signature(shingle_hashes(chunk['text'])) for chunk in chunks]
+    clusters = find_near_duplicates(signatures)
+    
+    dropped = set()
+    duplicate_map = {}
+    for members in clusters:
+        members.sort(key=lambda i: canonical_order(chunks[i]['year'], chunks[i]['filename'])
+                     + (chunks[i]['chunk_index'],))
+        canonical = chunks[members[0]]
+        canonical['duplicates'] = [
+            {
+                'id': chunks[i]['id'],
+                'author': chunks[i]['author'],
+                'title': chunks[i]['title'],
+                'year': chunks[i]['year'],
+                'filename': chunks[i]['filename'],
+                'chunk_index': chunks[i]['chunk_index']
+            }
+            for i in members[1:]
+        ]
+        for i in members[1:]:
+            dropped.add(i)
+            duplicate_map[chunks[i]['id']] = canonical['id']
+    
+    kept = [chunk for i, chunk in enumerate(chunks) if i not in dropped]
+    return kept, duplicate_map
+
 def process_all_narratives():
     """Process all downloaded narratives"""
     
@@ -81,8 +195,10 @@ def process_all_narratives():
     
     all_chunks = []
     
-    txt_files = [f for f in os.listdir(INPUT_DIR) 
-                 if f.endswith('.txt') and not f.startswith('_')]
+    txt_files = sorted(f for f in os.listdir(INPUT_DIR)
+                       if f.endswith('.txt') and not f.startswith('_'))
+    document_signatures = []
+    document_names = []
     
     print(f"Processing {len(txt_files)} narratives...")
     
@@ -101,6 +217,9 @@ def process_all_narratives():
             # Extract metadata
             metadata = extract_metadata_from_filename(filename)
             
+            document_signatures.append(minhash_signature(shingle_hashes(cleaned_text)))
+            document_names.append(filename)
+            
             # Chunk text
             chunks = chunk_text(cleaned_text)
             
@@ -122,6 +241,34 @@ def process_all_narratives():
         except Exception as e:
             print(f"  ERROR: {str(e)}")
     
+    # Report narratives that are near-copies of each other
+    duplicate_narratives = []
+    for members in find_near_duplicates(document_signatures):
+        names = sorted((document_names[i] for i in members),
+                       key=lambda name: canonical_order(
+                           extract_metadata_from_filename(name)['year'], name))
+        entry = {'canonical': names[0], 'duplicates': names[1:]}
+        print(f"Near-duplicate narratives: {names[0]} (canonical) <- {', '.join(names[1:])}")
+        
+        # Different titles with the same text usually means download.NARRATIVES
+        # points at the wrong Gutenberg ID; the text may belong to neither title
+        titles = set(extract_metadata_from_filename(name)['title'] for name in names)
+        if len(titles) > 1:
+            entry['warning'] = ("Different titles share the same text; check download.NARRATIVES "
+                                "for a wrong Gutenberg ID")
+            print(f"  WARNING: {entry['warning']}")
+        duplicate_narratives.append(entry)
+    
+    # Collapse near-duplicate chunks into canonical chunks
+    print(f"\nDetecting near-duplicate chunks...")
+    total_before = len(all_chunks)
+    all_chunks, duplicate_map = collapse_duplicate_chunks(all_chunks)
+    print(f"Collapsed {len(duplicate_map)} duplicate chunks ({total_before} -> {len(all_chunks)})")
+    
+    duplicates_file = os.path.join(OUTPUT_DIR, 'duplicate_chunks.json')
+    with open(duplicates_file, 'w', encoding='utf-8') as f:
+        json.dump(duplicate_map, f, indent=2)
+    
     # Save processed data
     output_file = os.path.join(OUTPUT_DIR, 'processed_chunks.json')
     with open(output_file, 'w', encoding='utf-8') as f:
@@ -140,7 +287,9 @@ def process_all_narratives():
         'total_narratives': len(txt_files),
         'unique_authors': len(authors),
         'year_range': f"{min(years)} - {max(years)}",
-        'avg_chunks_per_narrative': len(all_chunks) // len(txt_files)
+        'avg_chunks_per_narrative': len(all_chunks) // len(txt_files),
+        'duplicate_chunks_collapsed': len(duplicate_map),
+        'duplicate_narratives': duplicate_narratives
     }
     
     summary_file = os.path.join(OUTPUT_DIR, 'summary.json')
@@ -0,0 +1,196 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from typing import Dict
+
+
+class UpstreamUnavailable(Exception):
+    """Base error for upstream calls that were not attempted or did not finish"""
+
+
+class CircuitOpenError(UpstreamUnavailable):
+    """The circuit breaker is open, so the call was short-circuited"""
+
+
+class DeadlineExceeded(UpstreamUnavailable):
+    """The upstream call did not finish within its deadline"""
+
+
+class UpstreamSaturated(UpstreamUnavailable):
+    """Every upstream worker is busy (possibly with calls that timed out)"""
+
+
+class AdmissionController:
+    """Bounded admission for expensive requests.
+
+    Up to ``max_concurrent`` requests run at once and up to ``max_queue``
+    more may wait (for at most ``queue_timeout`` seconds) for a slot.
+    Anything beyond that is rejected immediately so the caller can answer
+    503 instead of piling up behind a slow upstream.
+    """
+
+    def __init__(self, max_concurrent: int = 4, max_queue: int = 4, queue_timeout: float = 2.0):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+
+        self._cond = threading.Condition()
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+
+    def try_acquire(self) -> bool:
+        with self._cond:
+            if self.active < self.max_concurrent:
+                self.active += 1
+                self.admitted += 1
+                return True
+
+            if self.waiting >= self.max_queue:
+                self.rejected += 1
+                return False
+
+            self.waiting += 1
+            try:
+                got_slot = self._cond.wait_for(lambda: self.active < self.max_concurrent,
+                                               timeout=self.queue_timeout)
+            finally:
+                self.waiting -= 1
+
+            if not got_slot:
+                self.rejected += 1
+                return False
+
+            self.active += 1
+            self.admitted += 1
+            return True
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+    def stats(self) -> Dict:
+        with self._cond:
+            return {
+                'active': self.active,
+                'waiting': self.waiting,
+                'max_concurrent': self.max_concurrent,
+                'max_queue': self.max_queue,
+                'admitted': self.admitted,
+                'rejected': self.rejected
+            }
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker.
+
+    After ``failure_threshold`` failures in a row the circuit opens and calls
+    are refused for ``reset_timeout`` seconds. Then a single trial call is
+    let through (half-open); its outcome closes or re-opens the circuit.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self.short_circuited = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                return self.HALF_OPEN
+            return self._state
+
+    def allow_request(self) -> bool:
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+
+            if self._state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    self.short_circuited += 1
+                    return False
+                self._state = self.HALF_OPEN
+
+            # Half-open: only one trial call at a time
+            if self._trial_in_flight:
+                self.short_circuited += 1
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+    def stats(self) -> Dict:
+        state = self.state
+        with self._lock:
+            return {
+                'state': state,
+                'consecutive_failures': self._failures,
+                'short_circuited': self.short_circuited
+            }
+
+
+class Upstream:
+    """Runs upstream calls under a circuit breaker and per-call deadlines.
+
+    Calls run on a small thread pool so the caller stops waiting when the
+    deadline passes even if the client library does not. A timed-out call
+    keeps its pool thread until the library gives up. A call is therefore
+    only submitted when a worker is free, so it never waits in the pool's
+    queue and queue time is never counted against the upstream.
+    """
+
+    def __init__(self, breaker: CircuitBreaker, max_workers: int = 8):
+        self.breaker = breaker
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='upstream')
+        self._workers = threading.BoundedSemaphore(max_workers)
+        self.saturated = 0
+
+    def call(self, fn, deadline: float, *args, **kwargs):
+        if not self._workers.acquire(blocking=False):
+            self.saturated += 1
+            raise UpstreamSaturated("All upstream workers are busy")
+
+        if not self.breaker.allow_request():
+            self._workers.release()
+            raise CircuitOpenError("Upstream circuit is open")
+
+        # The worker slot is freed when the call really ends, not at the deadline
+        future = self._executor.submit(fn, *args, **kwargs)
+        future.add_done_callback(lambda _: self._workers.release())
+        try:
+            result = future.result(timeout=deadline)
+        except FutureTimeout:
+            self.breaker.record_failure()
+            raise DeadlineExceeded(f"Upstream call exceeded {deadline}s deadline")
+        except Exception:
+            self.breaker.record_failure()
+            raise
+
+        self.breaker.record_success()
+        return result
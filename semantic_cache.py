@@ -0,0 +1,206 @@
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional
+
+import numpy as np
+
+
+class SemanticCache:
+    """Answer cache keyed on query embeddings instead of exact query text.
+
+    A lookup is a hit when a cached query is at least ``similarity_threshold``
+    cosine-similar to the new one AND the chunks retrieved for both queries
+    overlap by at least ``overlap_threshold`` (Jaccard over chunk ids). The
+    second check guards against reusing an answer that was written from
+    different passages.
+
+    Entries are tagged with the index version they were generated from and
+    only match lookups for that same version, so an answer written from an
+    old corpus is never served after a reload.
+
+    Every served answer gets a one-shot serve token; ``report_false_hit``
+    with that token records that the answer was wrong for the question and
+    drops the entry. Tokens only exist for served answers and work once, so
+    false hits can never exceed hits.
+    """
+
+    def __init__(self, dim: int = 768, capacity: int = 1000,
+                 similarity_threshold: float = 0.92,
+                 overlap_threshold: float = 0.6,
+                 policy: str = 'lru'):
+        if policy not in ('lru', 'lfu'):
+            raise ValueError(f"Unknown eviction policy: {policy}")
+
+        self.dim = dim
+        self.capacity = capacity
+        self.similarity_threshold = similarity_threshold
+        self.overlap_threshold = overlap_threshold
+        self.policy = policy
+
+        # Normalized query embeddings live in a fixed-size matrix; each entry
+        # owns one row (slot) so lookup is a single matrix-vector product.
+        self._vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self._occupied = np.zeros(capacity, dtype=bool)
+        self._versions = np.zeros(capacity, dtype=np.int64)
+        self._free_slots = list(range(capacity - 1, -1, -1))
+        self._entries = OrderedDict()  # slot -> entry dict, in LRU order
+        self._slots_by_id = {}  # entry id -> slot
+        self._serve_tokens = OrderedDict()  # serve token -> entry id, oldest first
+        self._max_serve_tokens = max(capacity * 4, 1)
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.overlap_rejections = 0
+        self.false_hits = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _normalize(embedding) -> Optional[np.ndarray]:
+        vec = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vec)
+        if norm == 0:
+            return None
+        return vec / norm
+
+    @staticmethod
+    def _overlap(a: frozenset, b: frozenset) -> float:
+        if not a and not b:
+            return 1.0
+        return len(a & b) / len(a | b)
+
+    def lookup(self, query_embedding, chunk_ids: Iterable[str], version: int = 0) -> Optional[Dict]:
+        """Return {'answer', 'serve_token'} for a near-duplicate query, or None"""
+        vec = self._normalize(query_embedding)
+        if vec is None or vec.shape[0] != self.dim:
+            return None
+        chunk_set = frozenset(chunk_ids)
+
+        with self._lock:
+            if not self._entries:
+                self.misses += 1
+                return None
+
+            scores = self._vectors @ vec
+            scores[~self._occupied | (self._versions != version)] = -1.0
+
+            # Walk candidates above the similarity threshold, best first, and
+            # take the first whose retrieved passages also agree.
+            candidates = np.flatnonzero(scores >= self.similarity_threshold)
+            candidates = candidates[np.argsort(-scores[candidates])]
+
+            rejected = False
+            for slot in candidates:
+                slot = int(slot)
+                entry = self._entries[slot]
+                if self._overlap(chunk_set, entry['chunk_ids']) >= self.overlap_threshold:
+                    entry['hits'] += 1
+                    entry['last_used'] = time.time()
+                    self._entries.move_to_end(slot)
+                    self.hits += 1
+                    return {'answer': entry['answer'], 'serve_token': self._issue_token(entry['id'])}
+                rejected = True
+
+            # A similar-enough query whose passages differ would have been
+            # served by an embedding-only cache; counted to tune the thresholds.
+            if rejected:
+                self.overlap_rejections += 1
+            self.misses += 1
+            return None
+
+    def store(self, query: str, query_embedding, chunk_ids: Iterable[str], answer: str,
+              version: int = 0):
+        """Add an answer to the cache, evicting an entry if full"""
+        vec = self._normalize(query_embedding)
+        if vec is None or vec.shape[0] != self.dim or self.capacity == 0:
+            return
+
+        with self._lock:
+            if not self._free_slots:
+                self._evict()
+
+            slot = self._free_slots.pop()
+            self._vectors[slot] = vec
+            self._occupied[slot] = True
+            self._versions[slot] = version
+            self._entries[slot] = {
+                'id': self._next_id,
+                'query': query,
+                'chunk_ids': frozenset(chunk_ids),
+                'answer': answer,
+                'hits': 0,
+                'last_used': time.time()
+            }
+            self._slots_by_id[self._next_id] = slot
+            self._next_id += 1
+
+    def _issue_token(self, entry_id: int) -> str:
+        # Caller holds self._lock
+        token = secrets.token_urlsafe(16)
+        self._serve_tokens[token] = entry_id
+        while len(self._serve_tokens) > self._max_serve_tokens:
+            self._serve_tokens.popitem(last=False)
+        return token
+
+    def report_false_hit(self, serve_token: str) -> bool:
+        """Record that a served cached answer was wrong and drop its entry.
+
+        Returns False for unknown, expired or already-used tokens.
+        """
+        with self._lock:
+            entry_id = self._serve_tokens.pop(serve_token, None)
+            if entry_id is None:
+                return False
+            self.false_hits += 1
+            slot = self._slots_by_id.get(entry_id)
+            if slot is not None:
+                self._remove(slot)
+            return True
+
+    def _remove(self, slot: int):
+        entry = self._entries.pop(slot)
+        del self._slots_by_id[entry['id']]
+        self._occupied[slot] = False
+        self._free_slots.append(slot)
+
+    def _evict(self):
+        if self.policy == 'lfu':
+            # Least hits first; OrderedDict order breaks ties by recency
+            slot = min(self._entries, key=lambda s: self._entries[s]['hits'])
+        else:
+            slot = next(iter(self._entries))
+
+        self._remove(slot)
+        self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._slots_by_id.clear()
+            self._serve_tokens.clear()
+            self._occupied[:] = False
+            self._free_slots = list(range(self.capacity - 1, -1, -1))
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'capacity': self.capacity,
+                'policy': self.policy,
+                'similarity_threshold': self.similarity_threshold,
+                'overlap_threshold': self.overlap_threshold,
+                'lookups': lookups,
+                'hits': self.hits,
+                'misses': self.misses,
+                'overlap_rejections': self.overlap_rejections,
+                'false_hits': self.false_hits,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'overlap_rejection_rate': self.overlap_rejections / lookups if lookups else 0.0,
+                # Share of served cached answers later reported as wrong
+                'false_hit_rate': self.false_hits / self.hits if self.hits else 0.0
+            }